@@ -8,21 +8,27 @@ For service implementations use the SimpleServer() class, for client implementat
 
 """
 
+import array
 import collections
+import errno
+import fcntl
 import json
+import mmap
 import os
 import re
 import select
 import signal
 import socket
+import time
 import traceback
 from types import (SimpleNamespace, GeneratorType)
 from inspect import signature
 import sys
+import threading
 
 class VarlinkEncoder(json.JSONEncoder):
     def default(self, o):
-        if isinstance(o, SimpleNamespace):
+        if isinstance(o, (SimpleNamespace, _Record)):
             return o.__dict__
         if isinstance(o,  VarlinkError):
             return o.as_dict()
@@ -30,20 +36,40 @@ class VarlinkEncoder(json.JSONEncoder):
 
 class VarlinkError(Exception):
     """The base class for varlink error exceptions"""
-    def __init__(self, message, namespaced = False):
+    def __init__(self, message, namespaced = False, interface = None):
         if not namespaced and not isinstance(message, dict):
             raise TypeError
         # normalize to dictionary
         super().__init__(json.loads(json.dumps(message, cls=VarlinkEncoder)))
+        # the Interface of the call, which failed, it may define the error type
+        self._interface = interface
 
     def error(self):
         """returns the exception varlink error name"""
         return self.args[0]['error']
 
     def parameters(self, namespaced = False):
-        """returns the exception varlink error parameters"""
+        """returns the exception varlink error parameters
+
+        If namespaced is True, the parameters are returned as a record object named after
+        the error, typed like the error of the interface of the call, which failed.
+        """
         if namespaced:
-            return json.loads(json.dumps(self.args[0]['parameters']), object_hook=lambda d: SimpleNamespace(**d))
+            parameters = self.args[0]['parameters']
+            interface_name, _, name = self.args[0]['error'].rpartition('.')
+            interface = self._interface
+            if interface is not None and interface._name == interface_name:
+                error = interface._members.get(name)
+                if isinstance(error, _Error):
+                    return interface._record_converter(error.type, name)(parameters)
+
+            if not isinstance(parameters, dict):
+                return _namespace(parameters)
+            try:
+                record = _record_class(name, tuple(parameters))
+            except (TypeError, ValueError):
+                return _namespace(parameters)
+            return record(**{k: _namespace(v) for k, v in parameters.items()})
         else:
             return self.args[0]['parameters']
 
@@ -70,6 +96,140 @@ class InvalidParameter(VarlinkError):
     def __init__(self, name):
         VarlinkError.__init__(self, {'error': 'org.varlink.service.InvalidParameter', 'parameters': {'parameter': name}})
 
+# Large strings can be passed out of band on unix sockets: the string is written to
+# a sealed memfd, which is sent with SCM_RIGHTS along with the message. The JSON
+# message carries {"_memfd": <size in bytes>} in place of the string, the file
+# descriptors of a message are consumed in the order of the references.
+_MEMFD_SEALS = getattr(fcntl, 'F_SEAL_SHRINK', 0) | getattr(fcntl, 'F_SEAL_GROW', 0) | getattr(fcntl, 'F_SEAL_WRITE', 0)
+_MEMFD_MAX_FDS = 253
+
+def _memfd_supported(sock):
+    return (hasattr(os, 'memfd_create') and hasattr(fcntl, 'F_ADD_SEALS') and
+            isinstance(sock, socket.socket) and sock.family == socket.AF_UNIX)
+
+def _memfd_create(value):
+    data = value.encode('utf-8')
+    fd = os.memfd_create('varlink', os.MFD_CLOEXEC | os.MFD_ALLOW_SEALING)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        fcntl.fcntl(fd, fcntl.F_ADD_SEALS, _MEMFD_SEALS | fcntl.F_SEAL_SEAL)
+    except:
+        os.close(fd)
+        raise
+    return fd, len(data)
+
+def _memfd_pack(value, threshold, fds):
+    """Returns a copy of value with all strings of at least threshold characters moved to memfds
+
+    The file descriptors are appended to fds.
+    """
+    if isinstance(value, str):
+        if len(value) < threshold or len(fds) >= _MEMFD_MAX_FDS:
+            return value
+        fd, size = _memfd_create(value)
+        fds.append(fd)
+        return {'_memfd': size}
+    if isinstance(value, (SimpleNamespace, _Record)):
+        value = value.__dict__
+    if isinstance(value, dict):
+        return {k: _memfd_pack(v, threshold, fds) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_memfd_pack(v, threshold, fds) for v in value]
+    return value
+
+def _memfd_read(fd, size):
+    """Returns the string stored in a sealed memfd and closes the file descriptor"""
+    try:
+        seals = fcntl.fcntl(fd, fcntl.F_GET_SEALS)
+        if seals & _MEMFD_SEALS != _MEMFD_SEALS or os.fstat(fd).st_size != size:
+            raise ConnectionError
+        if size == 0:
+            return ''
+        with mmap.mmap(fd, size, prot=mmap.PROT_READ) as m:
+            return str(m, 'utf-8')
+    except OSError:
+        raise ConnectionError
+    finally:
+        os.close(fd)
+
+def _memfd_hook(fds, hook=None):
+    """Returns a json object_hook, which replaces memfd references with the strings from fds"""
+    def _hook(d):
+        if len(d) == 1 and '_memfd' in d:
+            if not fds:
+                raise ConnectionError
+            return _memfd_read(fds.pop(0), d['_memfd'])
+        return hook(d) if hook else d
+    return _hook
+
+def _close_fds(fds):
+    for fd in fds:
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+    del fds[:]
+
+def _recv_fds(sock, size):
+    """recv() which also returns the file descriptors passed with SCM_RIGHTS"""
+    fds = array.array('i')
+    data, ancdata, _, _ = sock.recvmsg(size, socket.CMSG_SPACE(_MEMFD_MAX_FDS * fds.itemsize))
+    for level, ctype, cdata in ancdata:
+        if level == socket.SOL_SOCKET and ctype == socket.SCM_RIGHTS:
+            fds.frombytes(cdata[:len(cdata) - (len(cdata) % fds.itemsize)])
+    return data, list(fds)
+
+def _send_fds(sock, data, fds):
+    """send() the start of data together with fds and returns the number of bytes sent"""
+    return sock.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))])
+
+class _FdMessage(bytes):
+    """An encoded message with the file descriptors to be passed along"""
+    fds = []
+
+class _FdQueue:
+    """File descriptors received on a stream, tagged with the stream position of their message
+
+    File descriptors are sent with the first byte of a message, which is sent on its own.
+    A read may return the tail of earlier messages, but ends with the data the file
+    descriptors came with, so they belong to the last message starting in the read data.
+    """
+    def __init__(self):
+        self._fds = []
+        self._received = 0
+        self._consumed = 0
+
+    def received(self, data, fds):
+        if fds:
+            start = self._received + data.rfind(b'\0', 0, len(data) - 1) + 1
+            for fd in fds:
+                self._fds.append((start, fd))
+        self._received += len(data)
+
+    def consume(self, length):
+        """Returns the file descriptors, which arrived with the next length bytes of the stream"""
+        self._consumed += length
+        fds = [fd for pos, fd in self._fds if pos < self._consumed]
+        if fds:
+            self._fds = self._fds[len(fds):]
+        return fds
+
+    def close(self):
+        _close_fds([fd for _, fd in self._fds])
+        self._fds = []
+
+def _unix_address(address):
+    """Returns the socket address of a "unix:" varlink address"""
+    address = address[5:]
+    mode = address.rfind(';mode=')
+    if mode != -1:
+        address = address[:mode]
+    if address[0] == '@':
+        address = address.replace('@', '\0', 1)
+    return address
+
 class Client:
     """Varlink client class.
 
@@ -90,10 +250,10 @@ class Client:
     iface now holds an object with all the varlink methods available.
 
     Do varlink method call with varlink arguments and a
-    single varlink return struct wrapped in a namespace class:
+    single varlink return struct wrapped in a record class:
     >>> ret = iface.Monitor(initial_lines=1)
     >>> ret
-    namespace(entries=[namespace(cursor='s=[…]',
+    MonitorReply(entries=[Entry(cursor='s=[…]',
        message="req:1 'dhcp4-change' [wlp3s0][…]", priority='critical',
        process='nm-dispatcher', time='2018-01-29 12:19:59Z')])
     >>> ret.entries[0].process
@@ -113,7 +273,7 @@ class Client:
     2018-01-29 12:19:59Z: req:1 'dhcp4-change' [wlp3s0]: start running ordered scripts...
 
     "_more" is special to this python varlink binding. If "_more=True", then the method call does
-    not return a normal namespace wrapped varlink return value, but a generator,
+    not return a normal record wrapped varlink return value, but a generator,
     which yields the return values and waits (blocks) for the service to return more return values
     in the generator's .__next__() call.
     """
@@ -143,12 +303,7 @@ class Client:
             address = _resolve_interface(resolve_interface, resolver or "unix:/run/org.varlink.resolver")
 
         if address.startswith("unix:"):
-            address = address[5:]
-            mode = address.rfind(';mode=')
-            if mode != -1:
-                address = address[:mode]
-            if address[0] == '@':
-                address = address.replace('@', '\0', 1)
+            address = _unix_address(address)
         elif address.startswith("exec:"):
             executable = address[5:]
             s = socket.socket(socket.AF_UNIX)
@@ -200,12 +355,17 @@ class Client:
                 pass
             os.waitpid(self._childpid, 0)
 
-    def open(self, interface_name, namespaced = False):
+    def open(self, interface_name, namespaced = False, timeout = None, memfd_threshold = None, cache = None):
         """Open a new connection and get a client interface handle with the varlink methods installed.
 
         Arguments:
         interface_name -- an interface name, which the service this client object is
                           connected to, provides.
+        namespaced -- if True, varlink methods return record objects instead of dictionaries
+        timeout -- the default number of seconds a method call may take, None to block forever
+        memfd_threshold -- if set and the service provides the org.varlink.memfd interface, large
+                           strings are exchanged in sealed memfds, see ClientInterfaceProxy
+        cache -- a ReplyCache object for the replies of idempotent methods
 
         Exceptions:
         InterfaceNotFound -- if the interface is not found
@@ -222,7 +382,11 @@ class Client:
         except:
             raise ConnectionError
 
-        return ClientInterfaceProxy(self._interfaces[interface_name], s, namespaced = namespaced)
+        if not 'org.varlink.memfd' in self._interfaces:
+            memfd_threshold = None
+
+        return ClientInterfaceProxy(self._interfaces[interface_name], s, namespaced = namespaced, timeout = timeout,
+                                    memfd_threshold = memfd_threshold, cache = cache)
 
     def get_interfaces(self):
         """Returns the a list of Interface objects the service implements."""
@@ -239,6 +403,62 @@ class Client:
 
         self._interfaces[interface._name] = interface
 
+def cacheable(maxsize=128, ttl=None):
+    """Decorator for methods of an interface class, whose result only depends on the parameters.
+
+    The encoded replies are kept in a ReplyCache keyed by the canonical JSON of the parameters,
+    Service.handle() sends the cached reply without calling the method again:
+
+    @service.interface('com.example.math')
+    class Math:
+        @varlink.cacheable(maxsize=1024, ttl=60)
+        def Factor(self, n):
+            […]
+
+    The ReplyCache is available as the 'reply_cache' attribute of the method, e.g. to
+    invalidate() it. Calls with "more", "oneway" or "upgrade" and error replies are not
+    cached. Replies of cached methods are always sent inline, not in memfds.
+    """
+    def decorator(func):
+        func.reply_cache = ReplyCache(maxsize=maxsize, ttl=ttl)
+        return func
+
+    return decorator
+
+def broadcast(policy='drop', max_pending=64):
+    """Decorator for "more" methods of an interface class, whose replies are the same for all callers.
+
+    The SimpleServer runs one instance of the method for all "more" calls with the same
+    parameters, encodes every reply once and queues the same buffer to every subscriber.
+    Subscribers joining a running broadcast first get the latest reply.
+
+    @service.interface('com.example.monitor')
+    class Monitor:
+        @varlink.broadcast(policy='latest')
+        def Watch(self, path, _more=False):
+            […]
+
+    A subscriber with 'max_pending' replies queued is too slow to follow. With the policy
+    'drop' its connection is closed, with 'latest' its queued replies are replaced by the
+    latest one.
+    """
+    if policy not in ('drop', 'latest'):
+        raise ValueError("policy must be 'drop' or 'latest'")
+
+    def decorator(func):
+        func.broadcast = SimpleNamespace(policy=policy, max_pending=max_pending)
+        return func
+
+    return decorator
+
+class _Memfd:
+    """The org.varlink.memfd interface, which marks services passing large strings in memfds"""
+    def __init__(self, threshold):
+        self._threshold = threshold
+
+    def GetThreshold(self):
+        return {'threshold': self._threshold}
+
 class Service:
     """Varlink service server handler
 
@@ -271,22 +491,28 @@ class Service:
     Note: varlink only handles one method call at a time on one connection.
 
     """
-    def __init__(self, vendor='', product='', version='', interface_dir='.', namespaced=False):
+    def __init__(self, vendor='', product='', version='', interface_dir='.', namespaced=False, memfd_threshold=None):
         """Initialize the service with the data org.varlink.service.GetInfo() returns
 
         Arguments:
         interface_dir -- the directory with the *.varlink files for the interfaces
+        memfd_threshold -- if set, the service provides the org.varlink.memfd interface and
+                           strings of at least this many characters are passed in sealed
+                           memfds to clients, which announced support for it
         """
         self.vendor = vendor
         self.product = product
         self.version = version
         self.interface_dir = interface_dir
         self._namespaced = namespaced
+        self._memfd_threshold = memfd_threshold
 
         self.url = None
         self.interfaces = {}
         directory = os.path.dirname(__file__)
         self._add_interface(os.path.join(directory, 'org.varlink.service.varlink'), self)
+        if memfd_threshold is not None:
+            self._add_interface(os.path.join(directory, 'org.varlink.memfd.varlink'), _Memfd(memfd_threshold))
 
     def GetInfo(self):
         """The standardized org.varlink.service.GetInfo() varlink method."""
@@ -324,7 +550,8 @@ class Service:
                 if name not in method.in_type.fields:
                     raise InvalidParameter(name)
                 if self._namespaced:
-                    parameters[name] = json.loads(json.dumps(parameters[name]), object_hook=lambda d: SimpleNamespace(**d))
+                    convert = interface._record_converter(method.in_type.fields[name], method.name + 'Parameters_' + name)
+                    parameters[name] = convert(parameters[name])
 
             func = getattr(interface._handler, method_name, None)
             if not func or not callable(func):
@@ -364,31 +591,130 @@ class Service:
 
                         if not cont:
                             return
-                except ConnectionError as e:
-                    out.throw(e)
+                except (ConnectionError, GeneratorExit):
+                    # the client is gone, cancel the method
+                    try:
+                        out.throw(ConnectionError())
+                    except (StopIteration, ConnectionError):
+                        pass
+                    out.close()
+                    return
             else:
                 yield {'parameters': out or {}}
 
         except VarlinkError as error:
-            return error
+            yield error
         except Exception as error:
             traceback.print_exception(type(error), error, error.__traceback__)
-            return {'error': 'InternalError'}
+            yield {'error': 'InternalError'}
 
-    def handle(self,  message):
+    def handle(self,  message, fds=None):
         """This generator function handles any incoming message. Write any returned bytes to the output stream.
 
         for outgoing_message in service.handle(incoming_message):
             connection.write(outgoing_message)
+
+        A transport, which is able to pass file descriptors, hands in the list of file descriptors
+        received with the message as 'fds'. The returned messages then may carry file descriptors in
+        their 'fds' attribute, which have to be sent with the first byte of the message and closed
+        afterwards. Unused file descriptors in 'fds' are closed.
         """
-        if not message:
-            return
+        try:
+            if not message:
+                return
 
-        if message[-1] == 0:
-            message = message[:-1]
+            if message[-1] == 0:
+                message = message[:-1]
+
+            memfd = fds is not None and self._memfd_threshold is not None
+            if memfd:
+                message = json.loads(message, object_hook=_memfd_hook(fds))
+                memfd = isinstance(message, dict) and message.get('memfd', False)
+            else:
+                message = json.loads(message)
+        finally:
+            if fds:
+                _close_fds(fds)
+
+        cache, key = self._reply_cache(message)
+        if cache is not None:
+            reply = cache.get(key)
+            if reply is not None:
+                yield reply
+                return
+            memfd = False
+
+        replies = self._handle(message)
+        try:
+            for out in replies:
+                if cache is not None:
+                    reply = json.dumps(out, cls=VarlinkEncoder).encode('utf-8') + b'\0'
+                    if isinstance(out, dict) and 'parameters' in out and not out.get('continues', False):
+                        cache.put(key, reply)
+                    yield reply
+                    continue
+
+                if not memfd or not isinstance(out, dict) or 'parameters' not in out:
+                    yield json.dumps(out, cls=VarlinkEncoder).encode('utf-8') + b'\0'
+                    continue
+
+                out_fds = []
+                out['parameters'] = _memfd_pack(out['parameters'], self._memfd_threshold, out_fds)
+                reply = _FdMessage(json.dumps(out, cls=VarlinkEncoder).encode('utf-8') + b'\0')
+                reply.fds = out_fds
+                yield reply
+        finally:
+            # closing the generator early cancels the running method
+            replies.close()
+
+    def _handler_method(self, message):
+        method = message.get('method')
+        if not isinstance(method, str):
+            # left to _handle() to reply an error
+            return None
+
+        interface_name, _, method_name = method.rpartition('.')
+        interface = self.interfaces.get(interface_name)
+        if not interface:
+            return None
+        return getattr(interface._handler, method_name, None)
+
+    def _call_key(self, message):
+        parameters = message.get('parameters', {})
+        return (message['method'], json.dumps(parameters, sort_keys=True, separators=(',', ':')))
+
+    def _reply_cache(self, message):
+        """Returns the ReplyCache of the called method and the cache key, if the reply may be cached"""
+        if not isinstance(message, dict) or message.get('more') or message.get('oneway') or message.get('upgrade'):
+            return None, None
+
+        cache = getattr(self._handler_method(message), 'reply_cache', None)
+        if not isinstance(cache, ReplyCache):
+            return None, None
+
+        return cache, self._call_key(message)
+
+    def _broadcast(self, message):
+        """Returns the key and the options of a "more" call of a broadcast method, or (None, None)
+
+        Used by the SimpleServer to attach subscribers with the same call to one running method.
+        """
+        if b'"more"' not in message:
+            return None, None
+
+        try:
+            message = json.loads(message)
+        except ValueError:
+            return None, None
+
+        if not isinstance(message, dict) or not message.get('more') or message.get('oneway') or message.get('upgrade'):
+            return None, None
+
+        options = getattr(self._handler_method(message), 'broadcast', None)
+        if not isinstance(options, SimpleNamespace):
+            return None, None
 
-        for out in self._handle(json.loads(message)):
-            yield json.dumps(out, cls=VarlinkEncoder).encode('utf-8') + b'\0'
+        return self._call_key(message), options
 
     def _add_interface(self, filename, handler):
         if not os.path.isabs(filename):
@@ -420,6 +746,8 @@ class Interface:
             member = scanner.read_member()
             self._members[member.name] = member
 
+        self._converters = {}
+
     def get_description(self):
         """return the description string in varlink interface definition language"""
         return self._description
@@ -430,6 +758,64 @@ class Interface:
             return method
         raise MethodNotFound(name)
 
+    def _record_converter(self, vtype, name):
+        """Returns a function, which turns the decoded JSON value of a varlink type into record objects
+
+        The record classes are generated from the struct types of the interface and cached. Named
+        types get the name of their alias, anonymous structs the 'name' of the first converter
+        built for them.
+        """
+        converter = self._converters.get(id(vtype))
+        if converter:
+            return converter
+
+        if isinstance(vtype, _CustomType):
+            alias = self._members.get(vtype.name)
+            if isinstance(alias, _Alias):
+                converter = self._record_converter(alias.type, alias.name)
+            else:
+                converter = _namespace
+
+        elif isinstance(vtype, _Array):
+            convert_element = self._record_converter(vtype.element_type, name)
+
+            def converter(value):
+                if not isinstance(value, list):
+                    return value
+                return [convert_element(v) for v in value]
+
+        elif isinstance(vtype, _Struct):
+            try:
+                record = _record_class(name, tuple(vtype.fields))
+            except (TypeError, ValueError):
+                return _namespace
+
+            fields = {}
+
+            def converter(value):
+                if not isinstance(value, dict):
+                    return value
+                if not value.keys() <= fields.keys():
+                    return _namespace(value)
+                obj = record.__new__(record)
+                for field, v in value.items():
+                    convert_field = fields[field]
+                    setattr(obj, field, convert_field(v) if convert_field else v)
+                return obj
+
+            # register before the fields are resolved, types can be recursive
+            self._converters[id(vtype)] = converter
+            for field, field_type in vtype.fields.items():
+                if isinstance(field_type, (bool, int, float, str)):
+                    fields[field] = None
+                else:
+                    fields[field] = self._record_converter(field_type, name + '_' + field)
+        else:
+            converter = _identity
+
+        self._converters[id(vtype)] = converter
+        return converter
+
     def filter_params(self, vtype, args, kwargs):
         if isinstance(vtype, _CustomType):
             return self.filter_params(self._members.get(vtype.name), args, kwargs)
@@ -606,9 +992,136 @@ class _Error:
         self.name = name
         self.type = varlink_type
 
+class _Record:
+    """Base class of the record classes generated from varlink struct types
+
+    The attributes are stored in __slots__, attributes not present in the
+    message are not set, like with SimpleNamespace.
+    """
+    __slots__ = ()
+
+    def __init__(self, **kwargs):
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+
+    @property
+    def __dict__(self):
+        return {name: getattr(self, name) for name in self.__slots__ if hasattr(self, name)}
+
+    def __repr__(self):
+        return "%s(%s)" % (type(self).__name__, ", ".join("%s=%r" % item for item in self.__dict__.items()))
+
+    def __eq__(self, other):
+        if not isinstance(other, (_Record, SimpleNamespace)):
+            return NotImplemented
+        return self.__dict__ == other.__dict__
+
+    def __reduce__(self):
+        # the generated classes can not be looked up by name, they are generated again
+        return (_record, (type(self).__name__, self.__slots__, self.__dict__))
+
+_record_classes = {}
+
+def _record_class(name, fields):
+    """Returns the record class with the name and the tuple of field names, generated on first use"""
+    record = _record_classes.get((name, fields))
+    if record is None:
+        record = type(name, (_Record,), {'__slots__': fields})
+        _record_classes[(name, fields)] = record
+    return record
+
+def _record(name, fields, values):
+    """Rebuilds a pickled record object"""
+    return _record_class(name, fields)(**values)
+
+def _namespace(value):
+    """Converts a decoded JSON value of unknown type into SimpleNamespace objects"""
+    if isinstance(value, dict):
+        return SimpleNamespace(**{k: _namespace(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return [_namespace(v) for v in value]
+    return value
+
+def _identity(value):
+    return value
+
+class ReplyCache:
+    """A bounded cache for the replies of idempotent varlink methods
+
+    Entries are evicted least recently used first, when more than 'maxsize' replies are
+    cached, and when they are older than 'ttl' seconds. Replies are keyed by the method
+    and the canonical JSON of the parameters.
+
+    >>> cache = ReplyCache(maxsize=256, ttl=30, methods=['org.varlink.service'])
+    >>> service = client.open('org.varlink.service', cache=cache)
+    >>> service.GetInfo()
+    >>> cache.hits, cache.misses
+    (0, 1)
+
+    A cache may be shared by several ClientInterfaceProxy objects.
+    """
+    def __init__(self, maxsize=128, ttl=None, methods=()):
+        """Arguments:
+        maxsize -- the maximum number of cached replies
+        ttl -- the number of seconds a reply stays valid, None for no expiry
+        methods -- interface names, qualified or plain method names, whose replies are cached;
+                   replies of other methods and of "_more" calls are never cached
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._methods = set(methods)
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def cacheable(self, interface_name, method_name):
+        """Returns True, if replies of the method are cached"""
+        return (interface_name in self._methods or method_name in self._methods or
+                interface_name + '.' + method_name in self._methods)
+
+    def get(self, key):
+        """Returns the cached value for key or None and counts the hit or miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires is None or expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            expires = None if self.ttl is None else time.monotonic() + self.ttl
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, name=None):
+        """Drop the cached replies of an interface or method, or all replies if name is None"""
+        with self._lock:
+            if name is None:
+                self._entries.clear()
+                return
+
+            for key in list(self._entries):
+                method = key[0]
+                if method == name or method.rpartition('.')[2] == name or method.rpartition('.')[0] == name:
+                    del self._entries[key]
+
 class ClientInterfaceProxy:
     """A varlink client for an interface doing send/write and receive/read on a socket or file stream"""
-    def __init__(self, interface, file_or_socket, namespaced = False):
+    def __init__(self, interface, file_or_socket, namespaced = False, timeout = None, memfd_threshold = None,
+                 cache = None):
         """Creates an object with the varlink methods of an interface installed.
 
         The object allows to talk to a varlink service, which implements the specified interface
@@ -616,13 +1129,32 @@ class ClientInterfaceProxy:
 
         For monitor calls with '_more=True' a generator object is returned.
 
+        Every method accepts a '_timeout' keyword argument, which overrides the 'timeout' of
+        the proxy for this call. For '_more' calls the timeout applies to every single reply.
+        If the timeout expires, TimeoutError is raised and the connection is closed, because
+        the state of the stream is unknown. Any further call raises ConnectionError.
+
+        With 'memfd_threshold' set on a unix socket, the proxy announces to the service, that
+        it accepts large strings in sealed memfds passed with SCM_RIGHTS, and passes parameter
+        strings of at least 'memfd_threshold' characters the same way. Only set it for services
+        providing the org.varlink.memfd interface, other services may reject the calls.
+        Client.open() checks the interfaces of the service.
+
+        With a ReplyCache object as 'cache', the replies of the methods marked cacheable in it
+        are served from the cache, as long as they are valid.
+
         Arguments:
         interface - an Interface object
         file_or_socket - an open socket or io stream
-        namespaced - if True, varlink methods return SimpleNamespace objects instead of dictionaries
+        namespaced - if True, varlink methods return record objects instead of dictionaries
+        timeout - the default number of seconds a call may take, None to block forever
+        memfd_threshold - the minimum length of strings to be passed in memfds, None to disable
+        cache - a ReplyCache object for the replies of idempotent methods
         """
         self._interface = interface
         self._connection = file_or_socket
+        self._timeout = timeout
+        self._cache = cache
 
         if hasattr(self._connection,  'sendall'):
             self._sendall = True
@@ -639,8 +1171,16 @@ class ClientInterfaceProxy:
             self._recv = False
 
         self._in_use = False
+        self._closed = False
         self._in_buffer = b''
 
+        if memfd_threshold is not None and _memfd_supported(self._connection):
+            self._memfd_threshold = memfd_threshold
+            self._in_fds = _FdQueue()
+        else:
+            self._memfd_threshold = None
+            self._in_fds = None
+
         self._namespaced = namespaced
 
         for member in interface._members.values():
@@ -649,28 +1189,85 @@ class ClientInterfaceProxy:
 
     def _add_method(self, method):
         def _wrapped(*args, **kwds):
+            timeout = kwds.pop("_timeout", self._timeout)
             if "_more" in kwds and kwds.pop("_more"):
-                return self._call_more(method.name, *args, **kwds)
+                return self._call_more(method.name, *args, _timeout=timeout, **kwds)
             else:
-                return self._call(method.name, *args, **kwds)
+                return self._call(method.name, *args, _timeout=timeout, **kwds)
         _wrapped.__name__ = method.name
         # FIXME: add comments
         _wrapped.__doc__ = "Varlink call: " + method.signature
         setattr(self, method.name, _wrapped)
 
-    def _send(self, out):
-        if self._sendall:
-            self._connection.sendall(json.dumps(out, cls=VarlinkEncoder).encode('utf-8') + b'\0')
-        elif hasattr:
-            self._connection.write(json.dumps(out, cls=VarlinkEncoder).encode('utf-8') + b'\0')
+    def close(self):
+        """Close the connection. Any further call raises ConnectionError."""
+        self._closed = True
+        self._in_use = False
+        self._in_buffer = b''
+        if self._in_fds:
+            self._in_fds.close()
+        self._connection.close()
+
+    def _deadline(self, timeout):
+        if timeout is None:
+            return None
+        return time.monotonic() + timeout
+
+    def _remaining(self, deadline):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            self.close()
+            raise TimeoutError
+        return remaining
+
+    def _send(self, out, deadline=None):
+        fds = []
+        if self._memfd_threshold is not None:
+            out['memfd'] = True
+            out['parameters'] = _memfd_pack(out['parameters'], self._memfd_threshold, fds)
+
+        message = json.dumps(out, cls=VarlinkEncoder).encode('utf-8') + b'\0'
+        if not self._sendall:
+            self._connection.write(message)
+            return
 
-    def _next(self):
+        try:
+            if deadline is not None:
+                self._connection.settimeout(self._remaining(deadline))
+            if fds:
+                message = message[_send_fds(self._connection, message, fds):]
+            self._connection.sendall(message)
+        except socket.timeout:
+            self.close()
+            raise TimeoutError
+        finally:
+            _close_fds(fds)
+
+        if deadline is not None:
+            self._connection.settimeout(None)
+
+    def _next(self, deadline=None):
+        """Returns the next message and the file descriptors passed along"""
         while True:
-            message, _, self._in_buffer = self._in_buffer.partition(b'\0')
-            if message:
-                return message
-
-            if self._recv:
+            message, sep, rest = self._in_buffer.partition(b'\0')
+            if sep:
+                self._in_buffer = rest
+                fds = self._in_fds.consume(len(message) + 1) if self._in_fds is not None else []
+                if message:
+                    return message, fds
+                _close_fds(fds)
+                continue
+
+            if deadline is not None:
+                ready, _, _ = select.select([self._connection], [], [], self._remaining(deadline))
+                if not ready:
+                    self.close()
+                    raise TimeoutError
+
+            if self._in_fds is not None:
+                data, fds = _recv_fds(self._connection, 8192)
+                self._in_fds.received(data, fds)
+            elif self._recv:
                 data = self._connection.recv(8192)
             else:
                 data = self._connection.read(8192)
@@ -679,99 +1276,291 @@ class ClientInterfaceProxy:
                 raise ConnectionError
             self._in_buffer += data
 
-    def _nextMessage(self):
-        message = self._next()
-        if self._namespaced:
-            message = json.loads(message, object_hook=lambda d: SimpleNamespace(**d))
-            if hasattr(message, "error"):
-                raise VarlinkError(message, self._namespaced)
-            else:
-                return (message.parameters, hasattr(message, "continues") and message.continues)
-        else:
-            message = json.loads(message)
-            if 'error' in message:
-                raise VarlinkError(message, self._namespaced)
+    def _nextMessage(self, method, deadline=None):
+        message, fds = self._next(deadline)
+        try:
+            if self._in_fds is not None:
+                message = json.loads(message, object_hook=_memfd_hook(fds))
             else:
-                return (message['parameters'], ('continues' in message) and message['continues'])
+                message = json.loads(message)
+        finally:
+            _close_fds(fds)
 
+        if 'error' in message:
+            raise VarlinkError(message, self._namespaced, self._interface)
 
-    def _call(self, method_name, *args, **kwargs):
-        if self._in_use:
+        return (message.get('parameters', {}), message.get('continues', False))
+
+    def _reply(self, method, parameters):
+        if self._namespaced:
+            return self._interface._record_converter(method.out_type, method.name + 'Reply')(parameters)
+        return parameters
+
+    def _call(self, method_name, *args, _timeout=None, **kwargs):
+        if self._in_use or self._closed:
             raise ConnectionError
 
         method = self._interface.get_method(method_name)
 
         sparam = self._interface.filter_params(method.in_type, args, kwargs)
         out = {'method' : self._interface._name + "." + method_name, 'parameters' : sparam}
-        self._send(out)
+
+        key = None
+        if self._cache is not None and self._cache.cacheable(self._interface._name, method_name):
+            key = (out['method'], json.dumps(sparam, cls=VarlinkEncoder, sort_keys=True, separators=(',', ':')))
+            cached = self._cache.get(key)
+            if cached is not None:
+                return self._reply(method, json.loads(cached))
+
+        deadline = self._deadline(_timeout)
+        self._send(out, deadline)
 
         self._in_use = True
-        (ret, more) = self._nextMessage()
-        if more:
-            self._connection.close()
+        try:
+            (ret, more) = self._nextMessage(method, deadline)
+        except VarlinkError:
+            # the error reply was consumed completely
             self._in_use = False
+            raise
+        except:
+            self.close()
+            raise
+
+        if more:
+            self.close()
             raise ConnectionError
         self._in_use = False
-        return ret
 
-    def _call_more(self, method_name, *args, **kwargs):
-        if self._in_use:
+        if key is not None:
+            self._cache.put(key, json.dumps(ret))
+        return self._reply(method, ret)
+
+    def _call_more(self, method_name, *args, _timeout=None, **kwargs):
+        if self._in_use or self._closed:
             raise ConnectionError
 
         method = self._interface.get_method(method_name)
 
         sparam = self._interface.filter_params(method.in_type, args, kwargs)
         out = {'method' : self._interface._name + "." + method_name, 'more' : True, 'parameters' : sparam}
-        self._send(out)
+        self._send(out, self._deadline(_timeout))
 
         more = True
         self._in_use = True
-        while True:
-            (ret, more) = self._nextMessage()
-            yield ret
-            if not more:
-                break
-        self._in_use = False
+        try:
+            while more:
+                (ret, more) = self._nextMessage(method, self._deadline(_timeout))
+                if not more:
+                    self._in_use = False
+                yield self._reply(method, ret)
+        except VarlinkError:
+            self._in_use = False
+            raise
+        finally:
+            if self._in_use and not self._closed:
+                # the stream was abandoned with replies outstanding
+                self.close()
 
 # Used by the SimpleServer
 class _Connection:
     def __init__(self, _socket):
         self._socket = _socket
         self._in_buffer = b''
-        self._out_buffer = b''
+        # queue of outgoing messages, the same buffer may be queued on several connections
+        self._out_queue = collections.deque()
+        self._out_offset = 0
+        self._out_sent = 0
+        self._in_received = 0
+        # file descriptor passing, only on unix sockets
+        self._in_fds = _FdQueue() if _socket.family == socket.AF_UNIX else None
 
     def close(self):
+        if self._in_fds:
+            self._in_fds.close()
+        for message in self._out_queue:
+            _close_fds(getattr(message, 'fds', []))
+        self._out_queue.clear()
         self._socket.close()
 
     def events(self):
         events = 0
         if len(self._in_buffer) < (8 * 1024 * 1024):
             events |= select.EPOLLIN
-        if self._out_buffer:
+        if self._out_queue:
             events |= select.EPOLLOUT
         return events
 
+    def _send(self):
+        # gather the queued messages, file descriptors go with the first byte of their message,
+        # which is sent on its own, see _FdQueue
+        fds = None
+        buffers = []
+        size = 0
+        for message in self._out_queue:
+            if not buffers:
+                if self._out_offset == 0:
+                    fds = getattr(message, 'fds', None)
+                buffers.append(memoryview(message)[self._out_offset:])
+                if fds:
+                    break
+            elif getattr(message, 'fds', None):
+                break
+            else:
+                buffers.append(message)
+
+            size += len(buffers[-1])
+            if size >= 65536 or len(buffers) >= 64:
+                break
+
+        try:
+            if fds:
+                n = self._socket.sendmsg(buffers, [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))])
+                # sent, the peer holds its own references now; on failure they stay for the next try
+                _close_fds(fds)
+            else:
+                n = self._socket.sendmsg(buffers)
+        except (BlockingIOError, InterruptedError):
+            return
+
+        n += self._out_offset
+        while self._out_queue and n >= len(self._out_queue[0]):
+            n -= len(self._out_queue.popleft())
+            self._out_sent += 1
+        self._out_offset = n
+
     def dispatch(self, events):
+        if events & (select.EPOLLHUP | select.EPOLLERR) and not events & select.EPOLLIN:
+            raise ConnectionError
+
         if events & select.EPOLLOUT:
-            n = self._socket.send(self._out_buffer[:8192])
-            self._out_buffer = self._out_buffer[n:]
+            self._send()
 
         if events & select.EPOLLIN:
-            data = self._socket.recv(8192)
+            if self._in_fds is None:
+                data = self._socket.recv(8192)
+            else:
+                data, fds = _recv_fds(self._socket, 8192)
+                self._in_fds.received(data, fds)
             if len(data) == 0:
                 raise ConnectionError
+            self._in_received += len(data)
             self._in_buffer += data
 
     def read(self):
+        """Yields the complete messages received with the file descriptors passed along"""
         while True:
-            message, _, self._in_buffer = self._in_buffer.partition(b'\0')
-            if message:
-                yield message
-            else:
+            message, sep, rest = self._in_buffer.partition(b'\0')
+            if not sep:
+                # incomplete message
                 break
+            self._in_buffer = rest
+            fds = self._in_fds.consume(len(message) + 1) if self._in_fds is not None else None
+            if message:
+                yield message, fds
+            elif fds:
+                _close_fds(fds)
 
     def write(self, message):
-        self._out_buffer += message
+        if message:
+            self._out_queue.append(message)
+
+    def pending(self):
+        """Returns the number of queued messages"""
+        return len(self._out_queue)
+
+    def discard(self):
+        """Drops the queued messages, which are not partially sent"""
+        head = self._out_queue.popleft() if self._out_offset else None
+        for message in self._out_queue:
+            _close_fds(getattr(message, 'fds', []))
+        self._out_queue.clear()
+        if head is not None:
+            self._out_queue.append(head)
+
+class _TimerWheel:
+    """A hashed timing wheel with O(1) insertion and removal of timers
+
+    Used by the SimpleServer to expire idle and stalled connections. Timers are
+    hashed into slots of 'resolution' seconds. A timer, which lies more than one
+    revolution in the future, stays in its slot until its revolution is due.
+    """
+    def __init__(self, resolution=0.5, slots=256):
+        self._resolution = resolution
+        self._slots = [{} for _ in range(slots)]
+        self._where = {}
+        self._tick = self._current_tick()
+
+    def __len__(self):
+        return len(self._where)
+
+    def __contains__(self, key):
+        return key in self._where
+
+    def _current_tick(self):
+        return int(time.monotonic() / self._resolution)
+
+    def add(self, key, timeout):
+        """(Re-)arm the timer 'key' to expire in 'timeout' seconds"""
+        self.remove(key)
+        if not self._where:
+            self._tick = self._current_tick()
+
+        deadline = time.monotonic() + timeout
+        tick = max(-int(-deadline // self._resolution), self._tick)
+        index = tick % len(self._slots)
+        self._slots[index][key] = deadline
+        self._where[key] = index
+
+    def remove(self, key):
+        index = self._where.pop(key, None)
+        if index is not None:
+            del self._slots[index][key]
+
+    def timeout(self):
+        """Returns the number of seconds until the next timer is due, or -1 if no timer is armed"""
+        if not self._where:
+            return -1
+
+        for i in range(len(self._slots)):
+            if self._slots[(self._tick + i) % len(self._slots)]:
+                break
+
+        return max(0.0, (self._tick + i) * self._resolution - time.monotonic())
+
+    def expire(self):
+        """Advances the wheel to the current time and returns the keys of all expired timers"""
+        now = time.monotonic()
+        current = self._current_tick()
+        expired = []
+
+        # one revolution visits every slot
+        self._tick = max(self._tick, current - len(self._slots) + 1)
+
+        while self._tick <= current and self._where:
+            slot = self._slots[self._tick % len(self._slots)]
+            for key, deadline in list(slot.items()):
+                if deadline <= now:
+                    del slot[key]
+                    del self._where[key]
+                    expired.append(key)
+            self._tick += 1
+
+        if not self._where:
+            self._tick = current + 1
+
+        return expired
+
+class _Wait:
+    """Yielded by a handle() generator, which waits for a file descriptor to become ready
+
+    The SimpleServer polls 'fd' for the epoll 'events' and resumes the generator, when
+    it is ready or 'timeout' seconds passed. Without 'events' only the timeout is waited
+    for. Meanwhile the other connections are served.
+    """
+    def __init__(self, fd, events, timeout=None):
+        self.fd = fd
+        self.events = events
+        self.timeout = timeout
 
 class SimpleServer:
     """A simple single threaded unix domain socket server
@@ -779,16 +1568,253 @@ class SimpleServer:
     calls service.handle(message) for every zero byte separated incoming message
     and writes any return message from this generator function to the outgoing stream.
 
+    "more" calls of methods decorated with varlink.broadcast() and the same parameters
+    share one running method, see broadcast().
+
+    A handle() generator waiting for another file descriptor yields a _Wait object,
+    like the Gateway does for the connections to its services.
+
     Better use a framework like twisted to serve.
     """
-    def __init__(self,  service):
+    def __init__(self,  service, idle_timeout=None, request_timeout=None, max_connections=None, backlog=None):
+        """Arguments:
+        service -- the Service object handling the messages
+        idle_timeout -- close connections, which have been inactive for this number of seconds
+        request_timeout -- close connections, which did not complete sending a message
+                           or receiving a queued reply within this number of seconds
+        max_connections -- stop accepting new connections, while this number of connections is open
+        backlog -- the listen backlog of the socket
+        """
         self._service = service
         self.connections = {}
         self._more = {}
+        self._broadcasts = {}
+        self._subscriptions = {}
+        # connection fd -> _Wait of its method, and the waited for fd -> connection fd
+        self._waits = {}
+        self._waiting = {}
+        self._idle_timeout = idle_timeout
+        self._request_timeout = request_timeout
+        self._max_connections = max_connections
+        self._backlog = backlog
+        self._timers = _TimerWheel()
+        self._request_timers = {}
+        self._idle_timers = {}
+        self._epoll = None
+        self._socket = None
+        self._accepting = False
+
+    def _pause_accept(self):
+        if self._accepting:
+            self._epoll.unregister(self._socket)
+            self._accepting = False
+
+    def _resume_accept(self):
+        if not self._accepting:
+            self._epoll.register(self._socket, select.EPOLLIN)
+            self._accepting = True
+
+    def _accept(self):
+        while self._max_connections is None or len(self.connections) < self._max_connections:
+            try:
+                sock, _ = self._socket.accept()
+            except BlockingIOError:
+                return
+            except OSError as e:
+                if e.errno not in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                    raise
+                # out of resources, retry later
+                self._pause_accept()
+                self._timers.add(self._socket.fileno(), 1.0)
+                return
+
+            sock.setblocking(0)
+            connection = _Connection(sock)
+            self.connections[sock.fileno()] = connection
+            self._epoll.register(sock.fileno(), select.EPOLLIN)
+            self._update_timer(sock.fileno())
+
+        self._pause_accept()
+
+    def _update_timer(self, fd):
+        connection = self.connections[fd]
+        busy = fd in self._more or fd in self._subscriptions
+        transfer = connection._out_queue or (connection._in_buffer and not busy)
+        if transfer and self._request_timeout is not None:
+            # a message is in transfer, the deadline only moves, when a queued reply was sent completely
+            self._idle_timers.pop(fd, None)
+            if self._request_timers.get(fd) != connection._out_sent:
+                self._timers.add(fd, self._request_timeout)
+                self._request_timers[fd] = connection._out_sent
+            return
+
+        self._request_timers.pop(fd, None)
+        if self._idle_timeout is None or (busy and not transfer):
+            # the service is producing replies
+            self._idle_timers.pop(fd, None)
+            self._timers.remove(fd)
+            return
+
+        # the idle timer moves, when data was received or a queued reply was sent completely
+        activity = (connection._in_received, connection._out_sent)
+        if self._idle_timers.get(fd) != activity:
+            self._timers.add(fd, self._idle_timeout)
+            self._idle_timers[fd] = activity
+
+    def _close(self, fd):
+        connection = self.connections.pop(fd)
+        self._epoll.unregister(fd)
+        connection.close()
+        self._timers.remove(fd)
+        self._request_timers.pop(fd, None)
+        self._idle_timers.pop(fd, None)
+        if fd in self._waits:
+            # the waiting method closes the file descriptor, when it is cancelled
+            self._unwait(self._waits[fd].fd)
+
+        if fd in self._more:
+            # cancel the running method, queued messages are dropped with the connection
+            self._more.pop(fd).close()
+
+        if fd in self._subscriptions:
+            key = self._subscriptions.pop(fd)
+            broadcast = self._broadcasts[key]
+            broadcast.subscribers.discard(fd)
+            if not broadcast.subscribers:
+                # the last subscriber is gone, cancel the method
+                del self._broadcasts[key]
+                broadcast.producer.close()
+
+        if self._max_connections is None or len(self.connections) < self._max_connections:
+            if self._socket.fileno() not in self._timers:
+                self._resume_accept()
+
+    def _wait(self, fd, wait):
+        """Suspends the method of a connection, until the file descriptor it waits for is ready"""
+        if wait.events:
+            self._epoll.register(wait.fd, wait.events)
+        self._waits[fd] = wait
+        self._waiting[wait.fd] = fd
+        if wait.timeout is not None:
+            self._timers.add(wait.fd, wait.timeout)
+
+    def _unwait(self, wait_fd):
+        """Stops polling a file descriptor a method waits for and returns its connection"""
+        fd = self._waiting.pop(wait_fd)
+        if self._waits.pop(fd).events:
+            self._epoll.unregister(wait_fd)
+        self._timers.remove(wait_fd)
+        return fd
+
+    def _subscribe(self, fd, message):
+        """Attaches the connection to the broadcast of the call, returns False for other calls"""
+        if not isinstance(self._service, Service):
+            # services only providing handle() have no broadcast methods
+            return False
+
+        key, options = self._service._broadcast(message)
+        if key is None:
+            return False
+
+        broadcast = self._broadcasts.get(key)
+        if broadcast is None:
+            # memfds can not be shared, broadcast replies are always inline
+            broadcast = SimpleNamespace(producer=iter(self._service.handle(message)), options=options,
+                                        subscribers=set(), last=None)
+            self._broadcasts[key] = broadcast
+        elif broadcast.last is not None:
+            self.connections[fd].write(broadcast.last)
+
+        broadcast.subscribers.add(fd)
+        self._subscriptions[fd] = key
+        return True
+
+    def _broadcast_ready(self, broadcast):
+        # the fastest subscriber paces the method, slower ones do not hold it back
+        return any(not self.connections[fd].pending() for fd in broadcast.subscribers)
+
+    def _run_broadcasts(self):
+        for key, broadcast in list(self._broadcasts.items()):
+            if not self._broadcast_ready(broadcast):
+                continue
+
+            try:
+                reply = next(broadcast.producer)
+            except StopIteration:
+                del self._broadcasts[key]
+                for fd in broadcast.subscribers:
+                    del self._subscriptions[fd]
+                    # calls may be queued behind the finished one
+                    self._process(fd)
+                continue
+
+            broadcast.last = reply
+            for fd in list(broadcast.subscribers):
+                connection = self.connections[fd]
+                if connection.pending() >= broadcast.options.max_pending:
+                    if broadcast.options.policy == 'drop':
+                        self._close(fd)
+                        continue
+                    connection.discard()
+
+                connection.write(reply)
+                self._epoll.modify(fd, connection.events())
+                self._update_timer(fd)
+
+    def _process(self, fd, events=0):
+        """Dispatches the events of a connection and handles its queued messages"""
+        connection = self.connections[fd]
+        try:
+            if events:
+                connection.dispatch(events)
+
+            while not fd in self._subscriptions and not fd in self._waits:
+                if not fd in self._more:
+                    # only one method call at a time, further messages stay queued
+                    message, fds = next(connection.read(), (None, None))
+                    if message is None:
+                        break
+
+                    if not fds and self._subscribe(fd, message):
+                        break
+
+                    # Let the varlink service handle this, file descriptors only go to
+                    # services passing memfds, other handle() functions may not accept them
+                    if getattr(self._service, '_memfd_threshold', None) is not None:
+                        it = iter(self._service.handle(message, fds=fds))
+                    else:
+                        if fds:
+                            _close_fds(fds)
+                        it = iter(self._service.handle(message))
+                    if isinstance(it, GeneratorType):
+                        self._more[fd] = it
+                    else:
+                        raise TypeError
+
+                try:
+                    reply = next(self._more[fd])
+                    if isinstance(reply, _Wait):
+                        self._wait(fd, reply)
+                    elif reply != None:
+                        # write any reply pending
+                        connection.write(reply)
+                    break
+                except StopIteration:
+                    del self._more[fd]
+        except ConnectionError as e:
+            self._close(fd)
+            return
+        except Exception as error:
+            traceback.print_exception(type(error), error, error.__traceback__)
+            sys.exit(1)
+
+        self._epoll.modify(fd, connection.events())
+        self._update_timer(fd)
 
     def serve(self, address, listen_fd=None):
         if listen_fd:
             s = socket.fromfd(listen_fd, socket.AF_UNIX, socket.SOCK_STREAM)
+            s.setblocking(0)
         else:
             if address[0] == '@':
                 address = address.replace('@', '\0', 1)
@@ -796,57 +1822,341 @@ class SimpleServer:
             s = socket.socket(socket.AF_UNIX)
             s.setblocking(0)
             s.bind(address)
-            s.listen()
+            if self._backlog is None:
+                s.listen()
+            else:
+                s.listen(self._backlog)
 
-        epoll = select.epoll()
-        epoll.register(s, select.EPOLLIN)
+        self._socket = s
+        self._epoll = epoll = select.epoll()
+        self._resume_accept()
 
         while True:
-            for fd, events in epoll.poll():
+            timeout = self._timers.timeout()
+            if any(self._broadcast_ready(broadcast) for broadcast in self._broadcasts.values()):
+                timeout = 0
+
+            for fd, events in epoll.poll(timeout):
                 if fd == s.fileno():
-                    sock, _ = s.accept()
-                    sock.setblocking(0)
-                    connection = _Connection(sock)
-                    self.connections[sock.fileno()] = connection
-                    epoll.register(sock.fileno(), select.EPOLLIN)
-                else:
-                    connection = self.connections.get(fd)
-                    try:
-                        connection.dispatch(events)
-
-                        if not fd in self._more:
-                            for message in connection.read():
-                                    # Let the varlink service handle this
-                                    it = iter(self._service.handle(message))
-                                    if isinstance(it, GeneratorType):
-                                        self._more[fd] = it
-                                    else:
-                                        raise TypeError
-
-                        if fd in self._more:
-                            try:
-                                reply = next(self._more[fd])
-                                if reply != None:
-                                    # write any reply pending
-                                    connection.write(reply)
-                            except StopIteration:
-                                del self._more[fd]
-                    except ConnectionError as e:
-                        epoll.unregister(fd)
-                        connection.close()
-                        if fd in self._more:
-                            try:
-                                self._more[fd].throw(ConnectionError())
-                            except StopIteration:
-                                pass
-                            del self._more[fd]
-                        continue
-                    except Exception as error:
-                        traceback.print_exception(type(error), error, error.__traceback__)
-                        sys.exit(1)
+                    self._accept()
+                elif fd in self._waiting:
+                    self._process(self._unwait(fd))
+                elif fd in self.connections:
+                    self._process(fd, events)
+
+            for fd in self._timers.expire():
+                if fd == s.fileno():
+                    self._resume_accept()
+                    self._accept()
+                elif fd in self._waiting:
+                    # the method notices the timeout itself
+                    self._process(self._unwait(fd))
+                elif fd in self.connections:
+                    self._close(fd)
 
-                    epoll.modify(fd, connection.events())
+            self._run_broadcasts()
 
         s.close()
         epoll.close()
 
+class _Backend:
+    """A non-blocking connection of the Gateway to a service, passing the encoded messages through
+
+    connect(), send() and next() are generators, which yield _Wait objects until the socket
+    is ready. ConnectionError is raised, if the service does not get ready within 'timeout'
+    seconds.
+    """
+    def __init__(self, address, timeout=None):
+        if not address.startswith("unix:"):
+            # FIXME: also accept other transports
+            raise ConnectionError
+
+        self.address = address
+        self._timeout = timeout
+        self._socket = socket.socket(socket.AF_UNIX)
+        self._socket.setblocking(0)
+        self._in_buffer = b''
+
+    def close(self):
+        self._socket.close()
+
+    def _deadline(self):
+        if self._timeout is None:
+            return None
+        return time.monotonic() + self._timeout
+
+    def _wait(self, events, deadline, retry=None):
+        timeout = retry
+        if deadline is not None:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                raise ConnectionError
+            if retry is not None:
+                timeout = min(timeout, retry)
+        return _Wait(self._socket.fileno(), events, timeout)
+
+    def connect(self):
+        """Connects to the service, yields _Wait objects until the connection is established"""
+        deadline = self._deadline()
+        while True:
+            error = self._socket.connect_ex(_unix_address(self.address))
+            if error in (0, errno.EISCONN):
+                return
+            if error == errno.EAGAIN:
+                # the listen backlog of the service is full, the socket can not be polled for it
+                yield self._wait(0, deadline, retry=0.1)
+            elif error in (errno.EINPROGRESS, errno.EALREADY, errno.EINTR):
+                yield self._wait(select.EPOLLOUT, deadline)
+            else:
+                raise ConnectionError
+
+    def send(self, message):
+        """Sends the message, yields _Wait objects while the socket is not writable"""
+        deadline = self._deadline()
+        data = memoryview(message + b'\0')
+        while data:
+            try:
+                data = data[self._socket.send(data):]
+            except (BlockingIOError, InterruptedError):
+                yield self._wait(select.EPOLLOUT, deadline)
+            except OSError:
+                raise ConnectionError
+
+    def next(self):
+        """Returns the next message without the terminating zero byte, yields _Wait objects until it arrived"""
+        deadline = self._deadline()
+        while True:
+            message, sep, rest = self._in_buffer.partition(b'\0')
+            if sep:
+                self._in_buffer = rest
+                if message:
+                    return message
+                continue
+
+            try:
+                data = self._socket.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                yield self._wait(select.EPOLLIN, deadline)
+                continue
+            except OSError:
+                raise ConnectionError
+            if len(data) == 0:
+                raise ConnectionError
+            self._in_buffer += data
+
+class Gateway(Service):
+    """A varlink service forwarding the calls to the services implementing the called interface
+
+    Many short-lived clients talk to one long-lived gateway, which keeps a pool of persistent
+    connections to the services and caches their interface descriptions:
+
+    gateway = varlink.Gateway(interfaces=['io.systemd.journal', 'com.redhat.system.accounts'])
+    SimpleServer(gateway).serve('/run/org.example.gateway')
+
+    The service of an interface is looked up in 'addresses' or resolved with the resolver.
+    Calls and replies are passed through as encoded, "more" replies are streamed to the
+    client as they arrive. If a service connection fails while a call is forwarded, the
+    client connection is closed. Large strings are not passed in memfds through the gateway.
+    Calls with "upgrade" are refused, the gateway only passes varlink messages through.
+
+    The connections to the services are non-blocking. While a call waits for its service,
+    handle() yields _Wait objects and the SimpleServer serves the other clients.
+    """
+    def __init__(self, interfaces=(), addresses=None, resolver="unix:/run/org.varlink.resolver",
+                 max_idle=4, timeout=None, vendor='', product='Varlink Gateway', version='1'):
+        """Arguments:
+        interfaces -- the interface names GetInfo() reports
+        addresses -- a dictionary of interface names and the addresses of their services
+        resolver -- the address of the resolver for the interfaces not in 'addresses'
+        max_idle -- the maximum number of idle connections kept open per service
+        timeout -- the number of seconds to wait for a service, None to wait forever
+        """
+        super().__init__(vendor=vendor, product=product, version=version)
+        self._addresses = dict(addresses or {})
+        self._gateway_interfaces = list(interfaces) + [i for i in self._addresses if i not in interfaces]
+        self._resolver = resolver
+        self._max_idle = max_idle
+        self._timeout = timeout
+        self._pool = {}
+        self._descriptions = {}
+
+    def GetInfo(self):
+        """The org.varlink.service.GetInfo() varlink method, listing the forwarded interfaces."""
+        info = super().GetInfo()
+        info['interfaces'] += [i for i in self._gateway_interfaces if i not in info['interfaces']]
+        return info
+
+    def GetInterfaceDescription(self, interface):
+        """The org.varlink.service.GetInterfaceDescription() varlink method, answered from a cache.
+
+        handle() fetches the descriptions of forwarded interfaces into the cache.
+        """
+        if interface in self.interfaces:
+            return super().GetInterfaceDescription(interface)
+
+        description = self._descriptions.get(interface)
+        if description is None:
+            raise InterfaceNotFound(interface)
+
+        return {'description': description}
+
+    def _acquire(self, address):
+        """Returns a connection to the service, yields _Wait objects while connecting"""
+        idle = self._pool.get(address)
+        if idle:
+            return idle.pop()
+        return (yield from self._connect(address))
+
+    def _connect(self, address):
+        """Returns a new connection to the service, yields _Wait objects while connecting"""
+        backend = _Backend(address, self._timeout)
+        try:
+            yield from backend.connect()
+        except:
+            backend.close()
+            raise
+        return backend
+
+    def _release(self, backend):
+        idle = self._pool.setdefault(backend.address, [])
+        if len(idle) < self._max_idle:
+            idle.append(backend)
+        else:
+            backend.close()
+
+    def _request(self, address, method, parameters):
+        """Calls a method of a service and returns the reply parameters, yields _Wait objects meanwhile"""
+        backend = yield from self._acquire(address)
+        try:
+            yield from backend.send(json.dumps({'method': method, 'parameters': parameters}).encode('utf-8'))
+            reply = json.loads((yield from backend.next()))
+            if not isinstance(reply, dict):
+                raise ValueError
+        except ValueError:
+            # not a varlink reply
+            backend.close()
+            raise ConnectionError
+        except:
+            backend.close()
+            raise
+        self._release(backend)
+
+        if 'error' in reply:
+            raise VarlinkError(reply)
+        return reply.get('parameters', {})
+
+    def _fetch_description(self, interface):
+        """Caches the description of a forwarded interface, yields _Wait objects meanwhile"""
+        address = yield from self._route(interface)
+        reply = yield from self._request(address, 'org.varlink.service.GetInterfaceDescription',
+                                         {'interface': interface})
+        self._descriptions[interface] = reply['description']
+
+    def _route(self, interface):
+        """Returns the address of the service implementing the interface, yields _Wait objects meanwhile"""
+        address = self._addresses.get(interface)
+        if address is None:
+            try:
+                reply = yield from self._request(self._resolver, 'org.varlink.resolver.Resolve',
+                                                 {'interface': interface})
+                address = reply['address']
+            except (VarlinkError, ConnectionError, KeyError):
+                raise InterfaceNotFound(interface)
+            self._addresses[interface] = address
+        return address
+
+    def handle(self, message, fds=None):
+        """Forwards the message to the service of the called interface and yields the replies
+
+        org.varlink.service calls are answered by the gateway itself. While waiting for a
+        service, _Wait objects are yielded, see SimpleServer.
+        """
+        if fds:
+            _close_fds(fds)
+
+        if not message:
+            return
+
+        if message[-1] == 0:
+            message = message[:-1]
+
+        try:
+            call = json.loads(message)
+        except ValueError:
+            # not a varlink message, give up on the connection
+            raise ConnectionError
+
+        if not isinstance(call, dict) or not isinstance(call.get('method'), str):
+            yield json.dumps(InvalidParameter('method'), cls=VarlinkEncoder).encode('utf-8') + b'\0'
+            return
+        if not isinstance(call.get('parameters', {}), dict):
+            yield json.dumps(InvalidParameter('parameters'), cls=VarlinkEncoder).encode('utf-8') + b'\0'
+            return
+
+        method = call['method']
+        interface_name = method.rpartition('.')[0]
+        if method == 'org.varlink.service.GetInterfaceDescription':
+            interface = call.get('parameters', {}).get('interface')
+            if isinstance(interface, str) and interface not in self.interfaces and interface not in self._descriptions:
+                try:
+                    yield from self._fetch_description(interface)
+                except (VarlinkError, ConnectionError, KeyError):
+                    # not cached, GetInterfaceDescription() replies InterfaceNotFound
+                    pass
+
+        if interface_name == 'org.varlink.service' or interface_name in self.interfaces:
+            yield from super().handle(message)
+            return
+
+        try:
+            address = yield from self._route(interface_name)
+        except VarlinkError as error:
+            yield json.dumps(error, cls=VarlinkEncoder).encode('utf-8') + b'\0'
+            return
+
+        if call.get('upgrade', False):
+            # after the reply both connections would speak another protocol, which can
+            # neither be passed through nor be returned to the pool
+            yield json.dumps(InvalidParameter('upgrade'), cls=VarlinkEncoder).encode('utf-8') + b'\0'
+            return
+
+        if 'memfd' in call:
+            # the gateway does not pass file descriptors on
+            del call['memfd']
+            message = json.dumps(call).encode('utf-8')
+
+        backend = yield from self._acquire(address)
+        done = False
+        try:
+            try:
+                yield from backend.send(message)
+            except ConnectionError:
+                # the pooled connection may be stale, retry once with a new one
+                backend.close()
+                backend = yield from self._connect(address)
+                yield from backend.send(message)
+
+            if call.get('oneway', False):
+                done = True
+                return
+
+            while True:
+                reply = yield from backend.next()
+                more = False
+                if call.get('more', False) and b'"continues"' in reply:
+                    try:
+                        more = json.loads(reply).get('continues', False)
+                    except (ValueError, AttributeError):
+                        # not a varlink reply, the service connection is broken
+                        raise ConnectionError
+                if not more:
+                    done = True
+                yield reply + b'\0'
+                if not more:
+                    break
+        finally:
+            if done:
+                self._release(backend)
+            else:
+                # replies are outstanding, the connection can not be reused
+                backend.close()
@@ -0,0 +1,322 @@
+#!/usr/bin/python3
+
+"""A load generator for varlink services
+
+Measures the throughput and latency a Service served by the SimpleServer sustains.
+Without an address, the org.varlink.bench example service is started over "exec:".
+
+    $ python3 -m varlink.bench --connections 8 --duration 10 \
+          --call 'Echo={"data": "hello"}@3' --call 'List={"n": 100}' --subscribers 2
+
+    $ python3 -m varlink.bench --address unix:/run/org.example.service \
+          --call 'org.varlink.service.GetInfo'
+
+Every connection is driven by its own thread, which does one call after another
+choosing the method by the weights of the --call arguments. Subscribers repeatedly
+call the --subscribe method with "more" and count the replies. The RSS of the service
+is sampled from /proc while the load is running.
+"""
+
+import argparse
+import json
+import os
+import random
+import socket
+import stat
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+import varlink
+
+BENCH_INTERFACE = 'org.varlink.bench'
+
+service = varlink.Service(
+    vendor='varlink',
+    product='Load Generator Service',
+    version='1',
+    interface_dir=os.path.dirname(__file__)
+)
+
+@service.interface(BENCH_INTERFACE)
+class Bench:
+    def Echo(self, data):
+        return {'data': data}
+
+    def List(self, n):
+        return {'items': [{'id': i, 'name': 'item%d' % i} for i in range(n)]}
+
+    def Ticker(self, count, _more=False):
+        for i in range(count):
+            yield {'tick': i, '_continues': _more and i < count - 1}
+            if not _more:
+                return
+
+def serve(address, listen_fd=None):
+    """Serve the org.varlink.bench service on a "unix:" address or an inherited listen socket"""
+    if address.startswith('unix:'):
+        address = address[5:]
+    mode = address.rfind(';mode=')
+    if mode != -1:
+        address = address[:mode]
+
+    varlink.SimpleServer(service).serve(address, listen_fd=listen_fd)
+
+def _exec_address(directory):
+    """Returns an "exec:" address, which starts this module's service"""
+    path = os.path.join(directory, 'varlink-bench-service')
+    with open(path, 'w') as f:
+        f.write('#!%s\n' % sys.executable)
+        f.write('import sys\n')
+        f.write('sys.path.insert(0, %r)\n' % os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        f.write('from varlink.bench import serve\n')
+        f.write('serve(sys.argv[1], listen_fd=3)\n')
+    os.chmod(path, stat.S_IRWXU)
+    return 'exec:' + path
+
+def _peer_pid(proxy):
+    """Returns the pid of the service on the other end of a unix socket"""
+    creds = proxy._connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    pid, _, _ = struct.unpack('3i', creds)
+    return pid
+
+def _rss(pid):
+    """Returns the resident set size of a process in bytes, or None if it is not available"""
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+def parse_call(spec, default_interface):
+    """Parses '[interface.]Method[=JSON parameters][@weight]' into (interface, method, parameters, weight)"""
+    weight = 1
+    head, sep, tail = spec.rpartition('@')
+    if sep and tail.isdigit():
+        spec, weight = head, int(tail)
+
+    method, sep, parameters = spec.partition('=')
+    parameters = json.loads(parameters) if sep else {}
+    if not isinstance(parameters, dict):
+        raise ValueError('parameters of %s are not a JSON object' % method)
+
+    interface, _, method = method.strip().rpartition('.')
+    if not interface:
+        if not default_interface:
+            raise ValueError('%s is missing the interface name' % method)
+        interface = default_interface
+
+    return interface, method, parameters, weight
+
+class _Stats:
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.failures = 0
+        self.replies = 0
+
+def _open(client, proxies, interface, timeout):
+    proxy = proxies.get(interface)
+    if proxy is None or proxy._closed:
+        proxy = client.open(interface, timeout=timeout)
+        proxies[interface] = proxy
+    return proxy
+
+def _call_loop(client, calls, timeout, stop, stats, seed):
+    rng = random.Random(seed)
+    weights = [c[3] for c in calls]
+    proxies = {}
+
+    while not stop.is_set():
+        interface, method, parameters, _ = rng.choices(calls, weights)[0]
+        start = time.perf_counter()
+        try:
+            getattr(_open(client, proxies, interface, timeout), method)(**parameters)
+        except varlink.VarlinkError:
+            stats.errors += 1
+        except (ConnectionError, TimeoutError):
+            stats.failures += 1
+            continue
+        stats.latencies.append(time.perf_counter() - start)
+
+    for proxy in proxies.values():
+        proxy.close()
+
+def _subscribe_loop(client, call, timeout, stop, stats):
+    interface, method, parameters, _ = call
+    proxies = {}
+
+    while not stop.is_set():
+        try:
+            for _ in getattr(_open(client, proxies, interface, timeout), method)(_more=True, **parameters):
+                stats.replies += 1
+                if stop.is_set():
+                    break
+        except varlink.VarlinkError:
+            stats.errors += 1
+        except (ConnectionError, TimeoutError):
+            stats.failures += 1
+
+    for proxy in proxies.values():
+        proxy.close()
+
+def _percentile(latencies, p):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+
+def _histogram(latencies):
+    """Returns the number of calls per power of two microseconds bucket"""
+    buckets = {}
+    for latency in latencies:
+        bucket = 1
+        while bucket < latency * 1e6:
+            bucket *= 2
+        buckets[bucket] = buckets.get(bucket, 0) + 1
+    return sorted(buckets.items())
+
+def run(address, calls, subscribe=None, connections=4, subscribers=0, duration=10.0, timeout=None,
+        rss_interval=1.0):
+    """Runs the load and returns the results as a dictionary"""
+    client = varlink.Client(address=address)
+    if client._childpid:
+        # with "exec:" the listen socket is created by this process, the peer credentials are ours
+        pid = client._childpid
+    else:
+        proxy = client.open('org.varlink.service')
+        pid = _peer_pid(proxy)
+        proxy.close()
+
+    stop = threading.Event()
+    threads = []
+    call_stats = [_Stats() for _ in range(connections)]
+    subscribe_stats = [_Stats() for _ in range(subscribers)]
+
+    for i, stats in enumerate(call_stats):
+        threads.append(threading.Thread(target=_call_loop, args=(client, calls, timeout, stop, stats, i), daemon=True))
+    for stats in subscribe_stats:
+        threads.append(threading.Thread(target=_subscribe_loop, args=(client, subscribe, timeout, stop, stats), daemon=True))
+
+    rss = [(0.0, _rss(pid))]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+
+    while True:
+        elapsed = time.monotonic() - start
+        if elapsed >= duration:
+            break
+        time.sleep(min(rss_interval, duration - elapsed))
+        rss.append((time.monotonic() - start, _rss(pid)))
+
+    stop.set()
+    for thread in threads:
+        thread.join(timeout or 10.0)
+    elapsed = time.monotonic() - start
+
+    latencies = sorted(l for stats in call_stats for l in stats.latencies)
+    result = {
+        'address': address,
+        'server_pid': pid,
+        'duration': elapsed,
+        'connections': connections,
+        'subscribers': subscribers,
+        'calls': len(latencies),
+        'errors': sum(stats.errors for stats in call_stats),
+        'failures': sum(stats.failures for stats in call_stats),
+        'throughput': len(latencies) / elapsed,
+        'subscriber_replies': sum(stats.replies for stats in subscribe_stats),
+        'subscriber_throughput': sum(stats.replies for stats in subscribe_stats) / elapsed,
+        'latency': {},
+        'histogram': _histogram(latencies),
+        'rss': rss,
+    }
+    if latencies:
+        result['latency'] = {
+            'min': latencies[0],
+            'mean': sum(latencies) / len(latencies),
+            'p50': _percentile(latencies, 50),
+            'p90': _percentile(latencies, 90),
+            'p99': _percentile(latencies, 99),
+            'p99.9': _percentile(latencies, 99.9),
+            'max': latencies[-1],
+        }
+
+    del client
+    return result
+
+def print_report(result, out=sys.stdout):
+    out.write('address:      %s (pid %d)\n' % (result['address'], result['server_pid']))
+    out.write('duration:     %.2fs, %d connections, %d subscribers\n' %
+              (result['duration'], result['connections'], result['subscribers']))
+    out.write('calls:        %d (%d errors, %d failures)\n' % (result['calls'], result['errors'], result['failures']))
+    out.write('throughput:   %.1f calls/s\n' % result['throughput'])
+    if result['subscribers']:
+        out.write('subscribers:  %d replies, %.1f replies/s\n' %
+                  (result['subscriber_replies'], result['subscriber_throughput']))
+
+    if result['latency']:
+        out.write('\nlatency:\n')
+        for name, value in result['latency'].items():
+            out.write('  %-6s %10.1fus\n' % (name, value * 1e6))
+
+        out.write('\nhistogram:\n')
+        most = max(count for _, count in result['histogram'])
+        for bucket, count in result['histogram']:
+            out.write('  <= %8dus %8d %s\n' % (bucket, count, '#' * max(1, count * 40 // most)))
+
+    out.write('\nserver rss:\n')
+    for elapsed, rss in result['rss']:
+        out.write('  %6.1fs %s\n' % (elapsed, 'n/a' if rss is None else '%.1f MiB' % (rss / 1024 / 1024)))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python3 -m varlink.bench', description='varlink load generator')
+    parser.add_argument('--address', help='"unix:" or "exec:" address of the service, '
+                        'starts the %s service if not given' % BENCH_INTERFACE)
+    parser.add_argument('--interface', help='interface of methods given without one')
+    parser.add_argument('--call', action='append', default=[], metavar='SPEC',
+                        help="method to call: '[interface.]Method[=JSON parameters][@weight]', can be repeated")
+    parser.add_argument('--subscribe', metavar='SPEC', help="method to call with 'more' by subscribers")
+    parser.add_argument('-c', '--connections', type=int, default=4, help='number of calling connections')
+    parser.add_argument('-s', '--subscribers', type=int, default=0, help='number of subscribing connections')
+    parser.add_argument('-d', '--duration', type=float, default=10.0, help='seconds to run')
+    parser.add_argument('--timeout', type=float, help='seconds a call may take')
+    parser.add_argument('--rss-interval', type=float, default=1.0, help='seconds between RSS samples')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        address = args.address
+        interface = args.interface
+        if address is None:
+            address = _exec_address(directory)
+            interface = interface or BENCH_INTERFACE
+            calls = args.call or ['Echo={"data": "hello"}']
+            subscribe = args.subscribe or 'Ticker={"count": 100}'
+        else:
+            calls = args.call or ['org.varlink.service.GetInfo']
+            subscribe = args.subscribe
+
+        try:
+            calls = [parse_call(spec, interface) for spec in calls]
+            if args.subscribers:
+                if not subscribe:
+                    parser.error('--subscribers requires --subscribe')
+                subscribe = parse_call(subscribe, interface)
+        except ValueError as e:
+            parser.error(str(e))
+
+        result = run(address, calls, subscribe, connections=args.connections, subscribers=args.subscribers,
+                     duration=args.duration, timeout=args.timeout, rss_interval=args.rss_interval)
+
+    if args.json:
+        json.dump(result, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        print_report(result)
+
+if __name__ == '__main__':
+    main()